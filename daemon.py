@@ -19,6 +19,7 @@
 # IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import asyncio
 # daemonize should be installed with pip.
 from daemonize import Daemonize
 
@@ -28,7 +29,7 @@ def start():
     # Importing triggerpi will also import the automationhat module, which
     # starts a worker thread. This has to be done *after* daemonizing.
     import triggerpi
-    triggerpi.trigger()
+    asyncio.run(triggerpi.trigger())
 
 
 if __name__ == '__main__':
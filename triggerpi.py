@@ -67,167 +67,547 @@
 # installed before this program will run; instructions are in the project
 # README.md file at https://github.com/pimoroni/automation-hat/README.md.
 import automationhat
-import datetime
-from time import sleep
+import asyncio
+# RPi.GPIO is installed along with the automationhat module.
+import RPi.GPIO as GPIO
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+# gpiod is the python binding for libgpiod, which talks to the kernel's GPIO
+# character device. On raspbian it's installed with
+# "sudo apt install python3-libgpiod".
+import gpiod
+import mmap
+import signal
+import time
+from typing import Optional
 
 # The time (in seconds) to keep the outputs off while the input is on.
 POWERON_HOLD_TIME = 60
-# The time between reading the input, in seconds
+# The time between steps of the comms LED animation, in seconds
 READ_INTERVAL = 0.2
 # The time to wait for the second raising of the input before giving up and
 # going back to off.
 ARMED_HOLD_TIME = 30
+# The same times in integer nanoseconds, to compare against time.monotonic_ns().
+NS_PER_SECOND = 1000000000
+POWERON_HOLD_NS = int(POWERON_HOLD_TIME * NS_PER_SECOND)
+READ_INTERVAL_NS = int(READ_INTERVAL * NS_PER_SECOND)
+ARMED_HOLD_NS = int(ARMED_HOLD_TIME * NS_PER_SECOND)
+# The BCM GPIO numbers the AutomationHat wires its three inputs to.
+INPUT_PINS = (automationhat.INPUT_1, automationhat.INPUT_2,
+              automationhat.INPUT_3)
+# The relays, in the same order as the inputs that control them.
+RELAYS = (automationhat.relay.one, automationhat.relay.two,
+          automationhat.relay.three)
 
+# The automationhat functions we call when the outputs change, looked up once
+# here rather than through automationhat.light.comms.write etc. every time.
+# The write functions for the power, comms and warn LEDs:
+LIGHT_WRITES = (automationhat.light.power.write,
+                automationhat.light.comms.write,
+                automationhat.light.warn.write)
+# For each relay, its (pin, auto_light, light_no.write, light_nc.write). This
+# is filled in by setupOutputs(), since the pin isn't settled until the relay
+# has been set up.
+relay_outputs = ()
 
-def getInput():
+# The automationhat module drives the LEDs with this many brightness levels.
+LED_LEVELS = 128
+# The comms LED level for each READ_INTERVAL step of the power-on hold time.
+# The LED dims as the time runs out, but don't let it go below .01, or it will
+# turn off.
+COMMS_LEVELS = [
+    int(LED_LEVELS * max(.01, 1 - step * READ_INTERVAL / POWERON_HOLD_TIME))
+    for step in range(int(POWERON_HOLD_TIME / READ_INTERVAL) + 1)]
+
+# An input has to read the same this many times in a row before the state
+# machine sees the change, to filter out noise and contact bounce.
+DEBOUNCE_SAMPLES = 3
+# The time between those readings, in seconds.
+DEBOUNCE_INTERVAL = 0.02
+DEBOUNCE_INTERVAL_NS = int(DEBOUNCE_INTERVAL * NS_PER_SECOND)
+# A debounce history with every reading the same is a reading times this.
+HISTORY_FILL = sum(1 << (3 * n) for n in range(DEBOUNCE_SAMPLES))
+# The bits of the debounce history that hold readings, three per reading.
+HISTORY_MASK = 0b111 * HISTORY_FILL
+# The offset of the GPLEV0 register, which holds the levels of GPIOs 0-31, in
+# the BCM283x GPIO register block.
+GPLEV0 = 0x34
+
+# The input lines, requested from the kernel so we're told about edges.
+input_lines = None
+# The GPIO registers, mapped from /dev/gpiomem and viewed as 32-bit words so we
+# can read the levels of all three inputs at once.
+gpio_regs = None
+
+# Calls into the automationhat module block while they talk to the hardware,
+# so they're run on this executor instead of the event loop. It has a single
+# thread so that the calls are made in the order they were issued.
+hat_executor = ThreadPoolExecutor(max_workers=1)
+
+
+async def hat(fn, *args):
+    """
+    Call an automationhat function without blocking the event loop.
+
+    Args:
+      fn (callable): The automationhat function to call, e.g.
+                     automationhat.light.power.on.
+      args: Arguments to pass to fn.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(hat_executor, fn, *args)
+
+
+def setupInputs():
+    """
+    Request the three input lines from the GPIO character device.
+
+    The lines are requested for both rising and falling edge events, so the
+    kernel queues an event whenever an input changes and we don't have to keep
+    reading the inputs to find out.
+    """
+    global input_lines, gpio_regs
+    chip = gpiod.Chip('gpiochip0')
+    input_lines = chip.get_lines(INPUT_PINS)
+    input_lines.request(consumer='triggerpi',
+                        type=gpiod.LINE_REQ_EV_BOTH_EDGES)
+    # /dev/gpiomem maps just the GPIO registers, starting at offset 0, and
+    # doesn't need root.
+    with open('/dev/gpiomem', 'rb') as f:
+        regs = mmap.mmap(f.fileno(), mmap.PAGESIZE, prot=mmap.PROT_READ)
+    # The registers have to be read a whole word at a time. Indexing a
+    # memoryview cast to unsigned ints does a single aligned 32-bit load.
+    gpio_regs = memoryview(regs).cast('I')
+
+
+def read_inputs_bitmask():
     """
     Read the input signal and return it.
 
-    This reads inputs 1 2 and 3 and returns a tuple of 0 or 1 values, depending
-    on the voltage.
+    This reads inputs 1 2 and 3 and returns them packed into the low three bits
+    of an int: bit 0 is input 1, bit 1 is input 2 and bit 2 is input 3. A bit is
+    set if its input is high.
+
+    All three levels come from a single read of the GPLEV0 register, rather
+    than a request to the kernel for each line.
+    """
+    levels = gpio_regs[GPLEV0 // 4]
+    a, b, c = INPUT_PINS
+    return (levels >> a & 1) | (levels >> b & 1) << 1 | (levels >> c & 1) << 2
+
+
+def agreement(history):
+    """
+    Work out which inputs all the readings in a debounce history agree on.
+
+    Returns:
+      (high, stable): Bitmasks of the inputs that read high every time, and of
+      the inputs that read the same every time.
+    """
+    high = 0b111
+    low = 0b111
+    for sample in range(DEBOUNCE_SAMPLES):
+        reading = history >> (3 * sample)
+        high &= reading
+        low &= ~reading
+    return high, (high | low) & 0b111
+
+
+# agreement() for every possible history, so debouncing a reading is a single
+# lookup. There are only 2**(3 * DEBOUNCE_SAMPLES) histories.
+AGREEMENT = [agreement(history) for history in range(HISTORY_MASK + 1)]
+
+
+def debounce(history, bits, debounced):
+    """
+    Filter a new input reading against the last few.
+
+    The history holds the last DEBOUNCE_SAMPLES readings, three bits each with
+    the newest in the low bits. An input's debounced level only changes once
+    all of those readings agree on it.
+
+    Args:
+      history (int): The previous readings, as returned by the last call.
+      bits (int): The new reading, from read_inputs_bitmask().
+      debounced (int): The debounced input levels from the last call.
+
+    Returns:
+      (history, debounced, settled): The updated history and debounced levels,
+      and whether every input is steady. If not, debounce should be called again
+      after DEBOUNCE_INTERVAL.
+    """
+    history = (history << 3 | bits) & HISTORY_MASK
+    high, stable = AGREEMENT[history]
+    debounced = (debounced & ~stable) | high
+    return history, debounced, stable == 0b111
+
+
+def setupOutputs():
+    """Set up the relay GPIOs as outputs."""
+    global relay_outputs
+    for relay in RELAYS:
+        relay.setup()
+    relay_outputs = tuple((relay.pin, relay.auto_light, relay.light_no.write,
+                           relay.light_nc.write)
+                          for relay in RELAYS)
+
+
+def write_outputs(lights, relays, changed):
+    """
+    Write a batch of LED levels and relay settings to the hat.
+
+    The relays are all switched with a single GPIO call. The LED writes only
+    update the automationhat module's copy of the LED levels; its update thread
+    sends them all to the LED driver together.
+
+    Args:
+      lights (list): (write, level) pairs for the LEDs to change, where write
+                     is the LED's write function.
+      relays (int): Bitmask of the relays that should be on.
+      changed (int): Bitmask of the relays to switch.
+    """
+    for write, level in lights:
+        write(level)
+    pins = []
+    values = []
+    for bit, (pin, auto_light, write_no, write_nc) in enumerate(relay_outputs):
+        if changed >> bit & 1:
+            on = relays >> bit & 1
+            pins.append(pin)
+            values.append(on)
+            # Keep the relay's NO/NC LEDs in step, like relay.write() does.
+            if auto_light():
+                write_no(on)
+                write_nc(1 - on)
+    if pins:
+        GPIO.output(pins, values)
+
+
+async def animate_comms(state):
     """
-    return (automationhat.input.one.read(),
-            automationhat.input.two.read(),
-            automationhat.input.three.read())
+    Dim the comms LED as the power-on hold time runs out.
+
+    This runs as its own task while we're in the turning_on state, so the
+    input reader doesn't have to wake up for it.
+    """
+    # Entering the turning_on state has already turned the LED on full.
+    last_level = COMMS_LEVELS[0]
+    while True:
+        step = min(len(COMMS_LEVELS) - 1,
+                   (time.monotonic_ns() - state.started) // READ_INTERVAL_NS)
+        level = COMMS_LEVELS[step]
+        # Most steps don't change the level the LED ends up at; only write the
+        # ones that do.
+        if level != last_level:
+            await hat(LIGHT_WRITES[1], level / LED_LEVELS)
+            last_level = level
+        await asyncio.sleep(READ_INTERVAL)
+
+
+def changed_relays(relays, old):
+    """
+    Return a bitmask of the relays that need switching to get from old to
+    relays. If old is None we don't know how the relays are set, so all of
+    them need to be switched.
+    """
+    if old is None:
+        return (1 << len(RELAYS)) - 1
+    return relays ^ old
+
+
+@dataclass(frozen=True)
+class StateConfig:
+    """
+    Everything that makes one state of the state machine different from the
+    others.
+
+    The on_high, on_low and on_timeout fields name the state to move to when
+    any input is high, when all the inputs are low, and when the hold time
+    runs out. None means stay in this state.
+    """
+    name: str
+    # The (power, comms, warn) LED levels to show in this state.
+    lights: tuple
+    # The relays to turn on when entering this state, as a bitmask in the same
+    # layout as read_inputs_bitmask() returns. None means the relays follow
+    # the inputs instead.
+    relays: Optional[int]
+    # The longest time (in seconds) to go without reading the inputs. Edges
+    # wake us up straight away, and the wait never runs past the end of the
+    # hold time, so this is only a slow backstop.
+    poll_interval: float
+    on_high: Optional[str]
+    on_low: Optional[str]
+    # How long (in nanoseconds) to stay in this state before giving up on the
+    # input, or None to stay as long as the input says to.
+    hold_ns: Optional[int] = None
+    on_timeout: Optional[str] = None
+    # Dim the comms LED as the hold time runs out.
+    dim_comms: bool = False
+
+
+# All the LEDs and relays are off. If any input goes high, start turning on.
+OFF = StateConfig(name='off', lights=(0, 0, 0), relays=0, poll_interval=1.0,
+                  on_high='turning_on', on_low=None)
+# The power light is on. If all inputs are 0 again, the amp is mostly started
+# and has gotten around to initializing the triggers, so go to the armed
+# state. Otherwise, wait until the hold time is up.
+TURNING_ON = StateConfig(name='turning_on', lights=(1, 1, 0), relays=0,
+                         poll_interval=1.0,
+                         on_high=None, on_low='armed',
+                         hold_ns=POWERON_HOLD_NS, on_timeout='armed',
+                         dim_comms=True)
+# We stay in this state as long as all the inputs are 0, or until the hold
+# time is up.
+ARMED = StateConfig(name='armed', lights=(1, 0, 1), relays=0,
+                    poll_interval=1.0,
+                    on_high='on', on_low=None,
+                    hold_ns=ARMED_HOLD_NS, on_timeout='off')
+# The relays follow their inputs until all of them go low.
+ON = StateConfig(name='on', lights=(1, 0, 0), relays=None, poll_interval=0.5,
+                 on_high=None, on_low='off')
 
 
 class State:
-    def __init__(self):
+    def __init__(self, config):
+        self.config = config
+        # The states to move to, filled in by connect().
+        self.on_high = None
+        self.on_low = None
+        self.on_timeout = None
+        # When we got into this state, and when the hold time runs out, as
+        # time.monotonic_ns() values.
+        self.started = None
+        self.deadline = None
+        # The relays that are currently on, or None if we don't know.
+        self.relays = None
+        self.animation = None
+
+    def connect(self, states):
+        """
+        Look up the states this one moves to.
+
+        Args:
+          states (dict): All the states, keyed by name.
+        """
+        self.on_high = states.get(self.config.on_high)
+        self.on_low = states.get(self.config.on_low)
+        self.on_timeout = states.get(self.config.on_timeout)
+
+    def expired(self):
+        """Return True if the state's hold time has run out."""
+        return (self.deadline is not None and
+                time.monotonic_ns() >= self.deadline)
+
+    def timeout(self):
+        """
+        Return how long (in seconds) the state can wait for an input edge
+        before it needs to see the input again anyway.
+        """
+        if self.deadline is None:
+            return self.config.poll_interval
+        remaining = max(0, self.deadline - time.monotonic_ns())
+        return min(self.config.poll_interval, remaining / NS_PER_SECOND)
+
+    async def enter(self, prev):
+        """
+        Set the outputs for the state. Called each time we move into it.
+
+        Only the LEDs and relays that differ from the previous state are
+        written, to save talking to the hat when nothing would change.
+
+        Args:
+          prev (State): The state we're leaving, or None if this is the first
+                        state.
+        """
+        config = self.config
         # Remember when we got into this state
-        self.started = datetime.datetime.now()
-
-    def input(self, input):
-        pass
-
-
-class StateOff(State):
-    def __init__(self):
-        State.__init__(self)
-        # Turn the power LED off
-        automationhat.light.power.off()
-        automationhat.light.comms.off()
-        automationhat.light.warn.off()
-        # Turn off all three relays
-        automationhat.relay.one.off()
-        automationhat.relay.two.off()
-        automationhat.relay.three.off()
-
-    def input(self, input):
-        # If the input is currently 0 we'll stay off
-        if 1 in input:
-            # Any input is high. Move to the 'turning_on' state.
-            return 'turning_on'
-        return ''
-
-
-class StateTurningOn(State):
-    def __init__(self):
-        State.__init__(self)
-        # Turn the power light on.
-        automationhat.light.power.on()
-        automationhat.light.comms.on()
-        automationhat.light.warn.off()
-
-    def input(self, input):
-        # If all inputs are 0 again, the amp is mostly started and has gotten
-        # around to initializing the triggers. Go to the armed state.
-        if 1 not in input:
-            return 'armed'
-        # Otherwise, see how long since the input went high, and dim the comms
-        # LED as more time elapses.
-        elapsed = (datetime.datetime.now() - self.started).total_seconds()
-        if elapsed >= POWERON_HOLD_TIME:
-            return 'armed'
-        pct_elapsed = elapsed / POWERON_HOLD_TIME
-        # Don't let the brightness of the comms led go below .01, or it will
-        # turn off.
-        brightness = max(.01, 1 - pct_elapsed)
-        automationhat.light.comms.write(brightness)
-        return ''
-
-
-class StateArmed(State):
-    def __init__(self):
-        State.__init__(self)
-        automationhat.light.power.on()
-        automationhat.light.comms.off()
-        automationhat.light.warn.on()
-
-    def input(self, input):
-        # We stay in this state as long as any input is 1.
-        if 1 in input:
-            return 'on'
-        elapsed = (datetime.datetime.now() - self.started).total_seconds()
-        if elapsed >= ARMED_HOLD_TIME:
-            return 'off'
-        return ''
-
-
-class StateOn(State):
-    def __init__(self):
-        State.__init__(self)
-        automationhat.light.power.on()
-        automationhat.light.comms.off()
-        automationhat.light.warn.off()
-
-    def input(self, input):
-        if 1 not in input:
-            return 'off'
-        # Set all three relays to match their inputs.
-        if input[0] == 1:
-            automationhat.relay.one.on()
-        else:
-            automationhat.relay.one.off()
-        if input[1] == 1:
-            automationhat.relay.two.on()
-        else:
-            automationhat.relay.two.off()
-        if input[2] == 1:
-            automationhat.relay.three.on()
+        self.started = time.monotonic_ns()
+        if config.hold_ns is not None:
+            self.deadline = self.started + config.hold_ns
+        old_lights = prev.config.lights if prev else (None, None, None)
+        lights = [(write, new)
+                  for write, old, new in zip(LIGHT_WRITES, old_lights,
+                                             config.lights)
+                  if new != old]
+        old_relays = prev.relays if prev else None
+        if config.relays is None:
+            # input() will set the relays.
+            relays = old_relays
+            changed = 0
         else:
-            automationhat.relay.three.off()
-        return ''
+            relays = config.relays
+            changed = changed_relays(relays, old_relays)
+        # Send everything to the hat at once.
+        if lights or changed:
+            await hat(write_outputs, lights, relays, changed)
+        self.relays = relays
+        if config.dim_comms:
+            self.animation = asyncio.create_task(animate_comms(self))
 
+    async def set_relays(self, relays):
+        """
+        Switch the relays whose setting differs from the current one.
 
-states = {'off': StateOff,
-          'turning_on': StateTurningOn,
-          'armed': StateArmed,
-          'on': StateOn}
+        Args:
+          relays (int): Bitmask of the relays that should be on.
+        """
+        changed = changed_relays(relays, self.relays)
+        if changed:
+            await hat(write_outputs, (), relays, changed)
+        self.relays = relays
+
+    async def leave(self):
+        """Clean up before moving to another state."""
+        if self.animation is not None:
+            self.animation.cancel()
+            self.animation = None
+
+    async def input(self, input):
+        """
+        Handle a reading of the inputs. Return the state to move to, or None to
+        stay in this one.
+        """
+        newstate = self.on_high if input else self.on_low
+        if newstate is None and self.expired():
+            newstate = self.on_timeout
+        if newstate is None and self.config.relays is None:
+            # Set all three relays to match their inputs.
+            await self.set_relays(input)
+        return newstate
+
+
+state_off = State(OFF)
+state_turning_on = State(TURNING_ON)
+state_armed = State(ARMED)
+state_on = State(ON)
+
+
+def connect_states(*states):
+    """Wire each of the states up to the states it moves to."""
+    by_name = {state.config.name: state for state in states}
+    for state in states:
+        state.connect(by_name)
+
+
+connect_states(state_off, state_turning_on, state_armed, state_on)
 current_state = None
 
 
-def set_state(state):
+async def set_state(state):
     """
     Set the current state of the state machine.
 
     Args:
-      state (string): The state to change to. If this is empty or None, then the
-                      current state is unchanged.
+      state (State): The state to change to. If this is None, then the current
+                     state is unchanged.
     """
     global current_state
-    if not state:
+    if state is None:
         return
-    current_state = states[state]()
+    prev = current_state
+    if prev is not None:
+        await prev.leave()
+    current_state = state
+    await current_state.enter(prev)
+
+
+async def handle_input(input):
+    """
+    Pass the input to the current state, and keep passing it along as long as
+    the state changes.
 
+    Since we only read the input when it changes, a new state won't see the
+    input that moved us into it unless we hand it over right away. (StateOn
+    needs it to set the relays, for instance.)
+    """
+    newstate = await current_state.input(input)
+    while newstate is not None:
+        await set_state(newstate)
+        newstate = await current_state.input(input)
+
+
+async def trigger():
+    """
+    Run the trigger monitor until we get a SIGTERM or SIGINT, then turn all the
+    outputs off and return.
+    """
+    setupInputs()
+    setupOutputs()
+    # Each input line has its own file descriptor that becomes readable when
+    # an edge event is queued on it. Have the event loop watch all three, and
+    # set an event to wake up the main loop whenever one of them fires.
+    loop = asyncio.get_running_loop()
+    edge = asyncio.Event()
+
+    def on_edge(line):
+        # Drain the event; we only care about the levels, which the main loop
+        # reads.
+        line.event_read()
+        edge.set()
+
+    for line in input_lines:
+        loop.add_reader(line.event_get_fd(), on_edge, line)
+
+    # Shut down cleanly when systemd stops us (or on ctrl-C), rather than dying
+    # part way through a transition and maybe leaving the relays on. The event
+    # loop wakes up for signals the same way it does for edges.
+    stop = asyncio.Event()
+
+    def on_signal():
+        stop.set()
+        edge.set()
+
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, on_signal)
 
-def trigger():
     # Our initial state depends on whether the input is currently low or high.
     # If it's low we'll start in the outputOff state; if it's high jump right to
     # the outputOn state.
-    if 1 in getInput():
-        set_state('on')
+    i = read_inputs_bitmask()
+    history = i * HISTORY_FILL
+    settled = True
+    # The earliest time.monotonic_ns() at which the next reading can go into
+    # the debounce history.
+    next_sample = 0
+    if i:
+        await set_state(state_on)
     else:
-        set_state('off')
+        await set_state(state_off)
+    await handle_input(i)
+
+    # Main loop: sleep until an input changes (or the current state wants to
+    # check the time), then pass the debounced input to the current state.
+    while not stop.is_set():
+        timeout = current_state.timeout()
+        if not settled:
+            # Keep reading until the inputs stop bouncing.
+            remaining = max(0, next_sample - time.monotonic_ns())
+            timeout = min(timeout, remaining / NS_PER_SECOND)
+        try:
+            await asyncio.wait_for(edge.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        # Any number of edges may have come in since we last read the input;
+        # one read of the levels covers all of them.
+        edge.clear()
+        if stop.is_set():
+            break
+        # While the inputs are bouncing, the readings that go into the history
+        # have to be DEBOUNCE_INTERVAL apart; an edge in between only restarts
+        # the wait.
+        now = time.monotonic_ns()
+        if settled or now >= next_sample:
+            history, i, settled = debounce(history, read_inputs_bitmask(), i)
+            next_sample = now + DEBOUNCE_INTERVAL_NS
+        await handle_input(i)
 
-    # Main loop: sleep until it's time to read the input, then pass the input
-    # to the current state.
-    while(True):
-        sleep(READ_INTERVAL)
-        i = getInput()
-        newstate = current_state.input(i)
-        set_state(newstate)
+    for line in input_lines:
+        loop.remove_reader(line.event_get_fd())
+    await set_state(state_off)
 
 
 if __name__ == '__main__':
     print('Starting trigger monitor')
-    trigger()
+    asyncio.run(trigger())